@@ -3,9 +3,26 @@
 Functions for parsing xml files retrieved from the ops register service
 
 """
+import bisect
+import contextlib
+import contextvars
 import datetime
+import heapq
+import itertools
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import traceback
 import xml.etree.ElementTree as ET
 
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
+from array import array
+from collections import Counter
 from operator import itemgetter
 
 ns = {
@@ -14,24 +31,25 @@ ns = {
 }
 
 
-def from_string(xmlstring):
+def from_string(xmlstring, where=None):
     root = ET.fromstring(xmlstring)
-    return world_patent_data(root)
+    return world_patent_data(root, where)
 
 
-def world_patent_data(root):
+def world_patent_data(root, where=None):
     return {
-        "register_search": register_search(root.find("ops:register-search", ns)),
+        "register_search": register_search(root.find("ops:register-search", ns), where),
     }
 
 
-def register_search(node):
+def register_search(node, where=None):
     range_node = node.find("ops:range", ns)
     query_range = (int(range_node.attrib["begin"]), int(range_node.attrib["end"]))
     return {
         "register_documents": [
             register_document(x)
             for x in node.findall("reg:register-documents/reg:register-document", ns)
+            if where is None or where(x)
         ],
         "count": int(node.attrib["total-result-count"]),
         "query": get_text(node.find("ops:query", ns)),
@@ -50,6 +68,525 @@ def register_document(node):
     }
 
 
+"""Streaming"""
+
+
+register_document_tag = "{%s}register-document" % ns["reg"]
+
+
+class SchemaError(Exception):
+    """Register XML that is well-formed but not in the expected shape"""
+
+
+class DocumentError(Exception):
+    """A register document that could not be parsed
+
+    `index` is the position of the document in `source`, `function` the
+    parser function that failed and `error` the original exception.
+    `xml` holds the document for the "quarantine" error policy.
+
+    For XML syntax errors, which end the parsing of `source`, `index`
+    is the position of the last document read before the error and
+    `function` is None.
+
+    File object sources are recorded by name, so that errors can be
+    pickled, for example to pass them between processes.
+
+    """
+
+    def __init__(self, source, index, application_number, function, error, xml=None):
+        if not isinstance(source, (str, os.PathLike)):
+            source = source_name(source)
+        failed = f"{function} failed with" if function else "invalid XML:"
+        super().__init__(
+            f"Document {index} ({application_number}) in {source!r}: {failed} {error!r}"
+        )
+        self.source = source
+        self.index = index
+        self.application_number = application_number
+        self.function = function
+        self.error = error
+        self.xml = xml
+
+    def __reduce__(self):
+        return type(self), (
+            self.source,
+            self.index,
+            self.application_number,
+            self.function,
+            self.error,
+            self.xml,
+        )
+
+
+error_policies = ("raise", "skip", "quarantine")
+
+helper_functions = {
+    "date",
+    "get_text",
+    "local_name",
+    "procedural_step_date",
+    "procedural_step_text",
+    "step_child",
+    "time_limit",
+}
+
+
+def failing_function(error):
+    """Name of the innermost parser function in the traceback of `error`
+
+    Generic helpers are skipped in favour of the parser calling them.
+
+    """
+    names = [
+        x.name
+        for x in traceback.extract_tb(error.__traceback__)
+        if x.filename == __file__
+    ]
+    parsers = [x for x in names if x not in helper_functions]
+    return (parsers or names or [None])[-1]
+
+
+def safe_application_number(node):
+    try:
+        return european_application(node)["number"]
+    except Exception:
+        pass
+    numbers = [
+        (get_text(x.find("reg:country", ns)), get_text(x.find("reg:doc-number", ns)))
+        for x in node.iterfind(
+            "reg:bibliographic-data/reg:application-reference/reg:document-id", ns
+        )
+    ]
+    numbers.sort(key=lambda x: x[0] != "EP")
+    return numbers[0][1] if numbers else None
+
+
+def scan_documents(source, where=None, on_error="raise", errors=None, start=0):
+    """Yield (index, document) for every register document in `source`
+
+    `document` is None for documents that were filtered out or could
+    not be parsed. See `iter_documents` for the arguments.
+
+    """
+    if on_error not in error_policies:
+        raise ValueError(f"on_error must be one of {error_policies}")
+    index = 0
+    nodes = ET.iterparse(source)
+    while True:
+        try:
+            _, node = next(nodes, (None, None))
+        except ET.ParseError as e:
+            error = DocumentError(source, index - 1, None, None, e)
+            if on_error == "raise":
+                raise error from e
+            if errors is not None:
+                errors.append(error)
+            return
+        if node is None:
+            return
+        if node.tag != register_document_tag:
+            continue
+        doc = None
+        if index >= start:
+            try:
+                doc = register_document(node) if where is None or where(node) else None
+            except Exception as e:
+                error = DocumentError(
+                    source,
+                    index,
+                    safe_application_number(node),
+                    failing_function(e),
+                    e,
+                    (
+                        ET.tostring(node, encoding="unicode")
+                        if on_error == "quarantine"
+                        else None
+                    ),
+                )
+                if on_error == "raise":
+                    raise error from e
+                if errors is not None:
+                    errors.append(error)
+            yield index, doc
+        node.clear()
+        index += 1
+
+
+def iter_documents(source, where=None, on_error="raise", errors=None, start=0):
+    """Parse the register documents of an XML file one at a time
+
+    `source` is a filename or a binary file object. Documents failing
+    the `where` filter are skipped before they are parsed, as are the
+    first `start` documents.
+
+    A document that cannot be parsed raises a DocumentError when
+    `on_error` is "raise". With "skip" or "quarantine" the document is
+    left out and its DocumentError appended to the `errors` list, if
+    one is given; "quarantine" keeps the document's XML in the error.
+    An XML syntax error ends the file; with "skip" or "quarantine" it
+    is recorded the same way.
+
+    """
+    for _, doc in scan_documents(source, where, on_error, errors, start):
+        if doc is not None:
+            yield doc
+
+
+def parse_batch(
+    sources,
+    where=None,
+    on_error="raise",
+    errors=None,
+    checkpoint=None,
+    checkpoint_every=1000,
+):
+    """Parse the register documents of several XML files one at a time
+
+    See `iter_documents` for `where`, `on_error` and `errors`; with
+    "skip" or "quarantine" an XML syntax error moves on to the next
+    source. If `checkpoint` is a filename, the position after the last
+    consumed document is saved there every `checkpoint_every` scanned
+    documents and after each source. A later call with the same
+    sources and checkpoint resumes from that position; other sources
+    raise a ValueError.
+
+    """
+    sources = list(sources)
+    names = [source_name(x) for x in sources]
+    position = {"sources": names, "source": 0, "document": 0}
+    if checkpoint:
+        position = read_checkpoint(checkpoint, position)
+        if position["sources"] != names:
+            raise ValueError(f"Checkpoint {checkpoint!r} is for different sources")
+    scanned = 0
+    for i in range(position["source"], len(sources)):
+        start = position["document"] if i == position["source"] else 0
+        for index, doc in scan_documents(sources[i], where, on_error, errors, start):
+            if doc is not None:
+                yield doc
+            scanned += 1
+            if checkpoint and scanned % checkpoint_every == 0:
+                write_checkpoint(
+                    checkpoint, {"sources": names, "source": i, "document": index + 1}
+                )
+        if checkpoint:
+            write_checkpoint(
+                checkpoint, {"sources": names, "source": i + 1, "document": 0}
+            )
+
+
+def source_name(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    return getattr(source, "name", repr(source))
+
+
+def read_checkpoint(path, default):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def write_checkpoint(path, position):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(position, f)
+    os.replace(tmp, path)
+
+
+"""Document index"""
+
+
+document_index_version = 2
+
+
+def document_index_path(path):
+    return f"{path}.idx"
+
+
+def build_document_index(path):
+    """Record byte offset and length of each register document in `path`
+
+    The index is written next to the file and returned. It maps
+    application numbers to lists of (offset, length) pairs, one per
+    occurrence in file order, and lists the positions of documents
+    without a European application number under "unnumbered". It also
+    keeps the namespace declarations needed to parse a document on its
+    own.
+
+    """
+    reg = ns["reg"] + " "
+    parser = expat.ParserCreate(namespace_separator=" ")
+    namespaces = {}
+    positions = []
+    stack = []
+    state = {"encoding": "utf-8", "start": None, "text": None}
+
+    def xml_decl(version, encoding, standalone):
+        if encoding:
+            state["encoding"] = encoding
+
+    def start_namespace(prefix, uri):
+        if state["start"] is None:
+            namespaces[prefix or ""] = uri
+
+    def start_element(name, attrs):
+        stack.append(name)
+        if name == reg + "register-document":
+            state["start"] = parser.CurrentByteIndex
+            state["references"] = []
+        elif name == reg + "application-reference" and state["start"] is not None:
+            state["references"].append(
+                {"change-gazette-num": attrs.get("change-gazette-num", "")}
+            )
+        elif (
+            len(stack) > 3
+            and stack[-3] == reg + "application-reference"
+            and stack[-2] == reg + "document-id"
+            and name in (reg + "country", reg + "doc-number")
+        ):
+            state["text"] = []
+
+    def character_data(data):
+        if state["text"] is not None:
+            state["text"].append(data)
+
+    def end_element(name):
+        stack.pop()
+        if state["text"] is not None:
+            key = "country" if name == reg + "country" else "number"
+            state["references"][-1][key] = "".join(state["text"]).strip()
+            state["text"] = None
+        elif name == reg + "register-document":
+            application = get_latest_by_gazette_number(
+                x for x in state["references"] if x.get("country") == "EP"
+            )
+            number = application["number"] if application else None
+            positions.append((number, state["start"], parser.CurrentByteIndex))
+            state["start"] = None
+
+    parser.XmlDeclHandler = xml_decl
+    parser.StartNamespaceDeclHandler = start_namespace
+    parser.StartElementHandler = start_element
+    parser.CharacterDataHandler = character_data
+    parser.EndElementHandler = end_element
+
+    documents = {}
+    unnumbered = []
+    with open(path, "rb") as f:
+        parser.ParseFile(f)
+        for number, start, end_tag in positions:
+            f.seek(end_tag)
+            end = end_tag + f.read(1024).index(b">") + 1
+            if number:
+                documents.setdefault(number, []).append((start, end - start))
+            else:
+                unnumbered.append((start, end - start))
+
+    stat = os.stat(path)
+    index = {
+        "version": document_index_version,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "encoding": state["encoding"],
+        "namespaces": namespaces,
+        "documents": documents,
+        "unnumbered": unnumbered,
+    }
+    with open(document_index_path(path), "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    return index
+
+
+def document_index(path):
+    """Load the index of `path`, building it if it is missing or stale"""
+    try:
+        with open(document_index_path(path), encoding="utf-8") as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return build_document_index(path)
+    stat = os.stat(path)
+    if (
+        index.get("version") != document_index_version
+        or index["size"] != stat.st_size
+        or index["mtime"] != stat.st_mtime_ns
+    ):
+        return build_document_index(path)
+    return index
+
+
+def load_document(path, application_number, index=None, occurrence=-1):
+    """Parse the register document with `application_number` from `path`
+
+    Only the bytes of that document are read. Pass the result of
+    `document_index` as `index` when loading several documents. If
+    the application number occurs more than once, `occurrence` picks
+    one by its position in the file; the default is the last one.
+
+    """
+    if index is None:
+        index = document_index(path)
+    offset, length = index["documents"][application_number][occurrence]
+    with open(path, "rb") as f:
+        f.seek(offset)
+        fragment = f.read(length)
+    declarations = " ".join(
+        f"xmlns:{prefix}={quoteattr(uri)}" if prefix else f"xmlns={quoteattr(uri)}"
+        for prefix, uri in index["namespaces"].items()
+    )
+    encoding = index["encoding"]
+    root = ET.fromstring(
+        f'<?xml version="1.0" encoding="{encoding}"?><fragment {declarations}>'.encode(
+            encoding
+        )
+        + fragment
+        + b"</fragment>"
+    )
+    return register_document(root.find("reg:register-document", ns))
+
+
+"""Filters"""
+
+
+class Filter:
+    """Predicate on an unparsed register-document node
+
+    Filters combine with `&`, `|` and `~`. Combined filters evaluate
+    their parts in order of `cost`, so that cheap sections of the
+    document are looked at first.
+
+    """
+
+    def __init__(self, predicate, cost=0):
+        self.predicate = predicate
+        self.cost = cost
+
+    def __call__(self, node):
+        return self.predicate(node)
+
+    def __and__(self, other):
+        return AllOf([self, other])
+
+    def __rand__(self, other):
+        return AllOf([other, self])
+
+    def __or__(self, other):
+        return AnyOf([self, other])
+
+    def __ror__(self, other):
+        return AnyOf([other, self])
+
+    def __invert__(self):
+        return Filter(lambda node: not self(node), self.cost)
+
+
+class AllOf(Filter):
+    """Filter matching if all of `filters` match
+
+    Nested AllOf filters are merged, so all parts are evaluated in
+    order of cost. The cost is that of the most expensive part.
+
+    """
+
+    def __init__(self, filters):
+        self.filters = sorted(
+            (
+                x
+                for f in map(as_filter, filters)
+                for x in (f.filters if type(f) is type(self) else [f])
+            ),
+            key=lambda x: x.cost,
+        )
+        super().__init__(self.evaluate, self.filters[-1].cost)
+
+    def evaluate(self, node):
+        return all(x(node) for x in self.filters)
+
+
+class AnyOf(AllOf):
+    """Filter matching if any of `filters` matches"""
+
+    def evaluate(self, node):
+        return any(x(node) for x in self.filters)
+
+
+def as_filter(predicate):
+    """Wrap a plain callable as a Filter that is evaluated last"""
+    if isinstance(predicate, Filter):
+        return predicate
+    return Filter(predicate, cost=float("inf"))
+
+
+def status_code(*codes):
+    def predicate(node):
+        return any(
+            x.attrib.get("status-code") in codes
+            for x in node.iterfind("reg:ep-patent-statuses/reg:ep-patent-status", ns)
+        )
+
+    return Filter(predicate, cost=0)
+
+
+def european_application(node):
+    return get_latest_by_gazette_number(
+        x
+        for x in map(
+            application_reference,
+            node.iterfind("reg:bibliographic-data/reg:application-reference", ns),
+        )
+        if x["country"] == "EP"
+    )
+
+
+def application_number(*numbers):
+    def predicate(node):
+        application = european_application(node)
+        return application is not None and application["number"] in numbers
+
+    return Filter(predicate, cost=1)
+
+
+def filing_date(start=None, end=None):
+    """Filing date between `start` and `end`, both inclusive"""
+
+    def predicate(node):
+        application = european_application(node)
+        if application is None or application["date"] is None:
+            return False
+        d = application["date"]
+        return (start is None or start <= d) and (end is None or d <= end)
+
+    return Filter(predicate, cost=1)
+
+
+def applicant_country(*countries):
+    def predicate(node):
+        return any(
+            get_text(x) in countries
+            for x in node.iterfind(
+                "reg:bibliographic-data/reg:parties/reg:applicants/reg:applicant/reg:addressbook/reg:address/reg:country",
+                ns,
+            )
+        )
+
+    return Filter(predicate, cost=2)
+
+
+def event_code(*codes):
+    def predicate(node):
+        return any(
+            get_text(x) in codes
+            for x in node.iterfind(
+                "reg:events-data/reg:dossier-event/reg:event-code", ns
+            )
+        )
+
+    return Filter(predicate, cost=3)
+
+
 """Patent status"""
 
 
@@ -71,7 +608,28 @@ def patent_status(node):
 """Bibliographic data"""
 
 
+bibliographic_tags = {
+    "application-reference",
+    "publication-reference",
+    "priority-claims",
+    "related-documents",
+    "parties",
+    "invention-title",
+    "references-cited",
+}
+
+party_tags = {"applicants", "agents"}
+
+
 def bibliographic_data(bib):
+    if coverage.get() is not None:
+        for x in bib:
+            if (tag := local_name(x.tag)) not in bibliographic_tags:
+                count_unhandled("bibliographic-data", tag)
+        for x in bib.iterfind("reg:parties/*", ns):
+            if (tag := local_name(x.tag)) not in party_tags:
+                count_unhandled("bibliographic-data", "parties/" + tag)
+
     data = {
         "country_code": "EP",
     }
@@ -169,7 +727,10 @@ def citation(node):
         if nplcit_node is not None:
             document = nplcit(nplcit_node)
         else:
-            raise Exception("Citation node lacks patcit and nplcit nodes")
+            count_unhandled(
+                "citation", " ".join(sorted(local_name(x.tag) for x in node))
+            )
+            raise SchemaError("Citation node lacks patcit and nplcit nodes")
     cited_phase = node.attrib.get("cited-phase", "")
     category = get_text(node.find("reg:category", ns))
     doi_node = node.find("reg:doi", ns)
@@ -257,7 +818,14 @@ def events(doc):
     ]
 
 
+event_tags = {"event-code", "event-date", "event-text"}
+
+
 def dossier_event(node):
+    if coverage.get() is not None:
+        for x in node:
+            if (tag := local_name(x.tag)) not in event_tags:
+                count_unhandled("dossier-event", tag)
     code = node.find("reg:event-code", ns).text
     ed = date(node.find("reg:event-date/reg:date", ns))
     description = node.find("reg:event-text", ns).text
@@ -279,25 +847,49 @@ def procedural_data(node):
 
 
 def procedural_step(node):
-    code = node.find("reg:procedural-step-code", ns).text
-    description = node.find(
-        "reg:procedural-step-text[@step-text-type='STEP_DESCRIPTION']", ns
-    ).text
+    if coverage.get() is None:
+        return parse_procedural_step(node)
+    token = step_lookups.set(set())
+    try:
+        step = parse_procedural_step(node)
+        count_unhandled_step_children(node, step["code"], step_lookups.get())
+    finally:
+        step_lookups.reset(token)
+    return step
+
+
+def parse_procedural_step(node):
+    code = step_child(node, "procedural-step-code").text
+    description = procedural_step_text(node, "STEP_DESCRIPTION").text
     step = {"code": code, "description": description}
     if parser := step_parsers.get(code):
         step.update(parser(node))
+    else:
+        count_unhandled("procedural-step-code", code)
     return step
 
 
+def count_unhandled_step_children(node, code, lookups):
+    """Count children of a step that its parser did not look up"""
+    for x in node:
+        tag = local_name(x.tag)
+        if tag == "procedural-step-date":
+            if ("date", name := x.attrib.get("step-date-type")) not in lookups:
+                count_unhandled("step-date-type", f"{code} {name}")
+        elif tag == "procedural-step-text":
+            if ("text", name := x.attrib.get("step-text-type")) not in lookups:
+                count_unhandled("step-text-type", f"{code} {name}")
+        elif ("child", tag) not in lookups:
+            count_unhandled("procedural-step", f"{code} {tag}")
+
+
 """Step specific parsers"""
 
 
 def abex(node):
     """Amendments"""
     date = procedural_step_date(node, "DATE_OF_REQUEST")
-    kind = node.find(
-        "reg:procedural-step-text[@step-text-type='Kind of amendment']", ns
-    )
+    kind = procedural_step_text(node, "Kind of amendment")
     return {"date": date, "kind": kind.text}
 
 
@@ -305,11 +897,7 @@ def adwi(node):
     """Application deemed to be withdrawn"""
     effective = procedural_step_date(node, "DATE_EFFECTIVE")
     dispatch = procedural_step_date(node, "DATE_OF_DISPATCH")
-    reason = get_text(
-        node.find(
-            "reg:procedural-step-text[@step-text-type='STEP_DESCRIPTION_NAME']", ns
-        )
-    )
+    reason = get_text(procedural_step_text(node, "STEP_DESCRIPTION_NAME"))
     return {"dispatch": dispatch, "reason": reason, "effective": effective}
 
 
@@ -322,7 +910,7 @@ def agra(node):
 def exre(node):
     """Examination report"""
     dispatch = procedural_step_date(node, "DATE_OF_DISPATCH")
-    tl = time_limit(node.find("reg:time-limit", ns))
+    tl = time_limit(step_child(node, "time-limit"))
     reply = procedural_step_date(node, "DATE_OF_REPLY")
     return {"date": dispatch, "time_limit": tl, "reply": reply}
 
@@ -336,16 +924,14 @@ def igra(node):
 
 
 def isat(node):
-    authority = get_text(
-        node.find("reg:procedural-step-text[@step-text-type='searching authority']", ns)
-    )
+    authority = get_text(procedural_step_text(node, "searching authority"))
     return {"authority": authority}
 
 
 def obso(node):
     """Invitation to file observations"""
     dispatch = procedural_step_date(node, "DATE_OF_DISPATCH")
-    tl = time_limit(node.find("reg:time-limit", ns))
+    tl = time_limit(step_child(node, "time-limit"))
     reply = procedural_step_date(node, "DATE_OF_REPLY")
     return {"dispatch": dispatch, "time_limit": tl, "reply": reply}
 
@@ -354,7 +940,7 @@ def opex(node):
     """Examination on admissibility of an opposition"""
     dispatch = procedural_step_date(node, "DATE_OF_DISPATCH")
     reply = procedural_step_date(node, "DATE_OF_REPLY")
-    sequence = node.find("[@step-text-type='sequence-number']")
+    sequence = procedural_step_text(node, "sequence-number")
     opponent = int(sequence.text) if sequence is not None else None
     return {
         "dispatch": dispatch,
@@ -364,9 +950,7 @@ def opex(node):
 
 
 def prol(node):
-    language = get_text(
-        node.find("reg:procedural-step-text[@step-text-type='procedure language']", ns)
-    )
+    language = get_text(procedural_step_text(node, "procedure language"))
     return {"language": language}
 
 
@@ -380,14 +964,14 @@ def revo(node):
 def rfee(node):
     """Renewal fees"""
     payment = procedural_step_date(node, "DATE_OF_PAYMENT")
-    year = int(node.find("reg:procedural-step-text[@step-text-type='YEAR']", ns).text)
+    year = int(procedural_step_text(node, "YEAR").text)
     return {"date": payment, "year": year}
 
 
 def rfpr(node):
     """Request for further processing"""
     request = procedural_step_date(node, "DATE_OF_REQUEST")
-    result_node = node.find("reg:procedural-step-result", ns)
+    result_node = step_child(node, "procedural-step-result")
     result = result_node.text if result_node is not None else None
     result_date = procedural_step_date(node, "RESULT_DATE")
     return {"request": request, "result": result, "result_date": result_date}
@@ -408,15 +992,19 @@ step_parsers = {
     "RFPR": rfpr,
 }
 
-
 """Helpers"""
 
 
+def local_name(tag):
+    return tag.rpartition("}")[2]
+
+
 def get_text(node):
     return node.text.strip() if node is not None and node.text else ""
 
 
 def procedural_step_date(node, name):
+    record_lookup(("date", name))
     el = node.find(
         "reg:procedural-step-date[@step-date-type='{}']/reg:date".format(name), ns
     )
@@ -425,6 +1013,16 @@ def procedural_step_date(node, name):
     return date(el)
 
 
+def procedural_step_text(node, name):
+    record_lookup(("text", name))
+    return node.find("reg:procedural-step-text[@step-text-type='{}']".format(name), ns)
+
+
+def step_child(node, tag):
+    record_lookup(("child", tag))
+    return node.find("reg:" + tag, ns)
+
+
 def time_limit(node):
     text = node.text
     if text.startswith("M"):
@@ -436,3 +1034,593 @@ def date(node):
     if node is None:
         return None
     return datetime.datetime.strptime(get_text(node), "%Y%m%d").date()
+
+
+"""Schema coverage"""
+
+
+coverage = contextvars.ContextVar("coverage", default=None)
+
+
+@contextlib.contextmanager
+def collect_coverage(counter=None):
+    """Tally unhandled schema elements while parsing inside the block
+
+    Yields a Counter keyed by (kind, name) tuples. Pass the same
+    counter to several blocks to aggregate over a batch.
+
+    """
+    if counter is None:
+        counter = Counter()
+    token = coverage.set(counter)
+    try:
+        yield counter
+    finally:
+        coverage.reset(token)
+
+
+step_lookups = contextvars.ContextVar("step_lookups", default=None)
+
+
+def record_lookup(key):
+    """Mark a child of the current procedural step as handled"""
+    if (lookups := step_lookups.get()) is not None:
+        lookups.add(key)
+
+
+def count_unhandled(kind, name):
+    if (counter := coverage.get()) is not None:
+        counter[(kind, name)] += 1
+
+
+def coverage_report(counter):
+    lines = []
+    for kind in sorted({kind for kind, _ in counter}):
+        lines.append(f"{kind}:")
+        for (k, name), n in counter.most_common():
+            if k == kind:
+                lines.append(f"  {n:>10}  {name}")
+    return "\n".join(lines)
+
+
+"""Text index"""
+
+
+token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return token_pattern.findall(text.casefold()) if text else []
+
+
+def indexed_texts(doc):
+    """Texts of a register document that are searchable in a TextIndex"""
+    bib = doc["bibliographic_data"]
+    for key, value in bib.items():
+        if key.startswith("title_"):
+            yield value
+    for c in bib["citations"]:
+        if c["document"]["publication_type"] == "npl":
+            yield c["document"]["text"]
+    for parties in bib["applicants"] + bib["agents"]:
+        for party in parties:
+            yield party["name"]
+            yield party["address"]
+
+
+class TextIndex:
+    """Inverted index over titles, NPL citations and party names
+
+    Documents are identified by their position in `documents`, which
+    holds their application numbers. Each posting list is an array of
+    unsigned ints in ascending document order. Adding a document with
+    an application number already in the index replaces the earlier
+    document; its position in `documents` is set to None and its
+    postings are ignored.
+
+    """
+
+    magic = b"OPSTIDX1"
+
+    def __init__(self):
+        self.documents = []
+        self.doc_ids = {}
+        self.postings = {}
+        self._terms = None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, number):
+        return number in self.doc_ids
+
+    def add(self, doc):
+        number = doc["bibliographic_data"]["application_number"]
+        if (old := self.doc_ids.get(number)) is not None:
+            self.documents[old] = None
+        doc_id = self.doc_ids[number] = len(self.documents)
+        self.documents.append(number)
+        terms = set()
+        for text in indexed_texts(doc):
+            terms.update(tokenize(text))
+        for term in terms:
+            if (posting := self.postings.get(term)) is None:
+                posting = self.postings[term] = array("I")
+            posting.append(doc_id)
+        self._terms = None
+
+    def update(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    def terms(self):
+        if self._terms is None:
+            self._terms = sorted(self.postings)
+        return self._terms
+
+    def prefix_ids(self, prefix):
+        terms = self.terms()
+        doc_ids = set()
+        for term in terms[bisect.bisect_left(terms, prefix) :]:
+            if not term.startswith(prefix):
+                break
+            doc_ids.update(self.postings[term])
+        return doc_ids
+
+    def lookup(self, terms, prefix=None):
+        doc_ids = None if prefix is None else self.prefix_ids(prefix)
+        for term in terms:
+            posting = self.postings.get(term, ())
+            doc_ids = set(posting) if doc_ids is None else doc_ids.intersection(posting)
+            if not doc_ids:
+                return []
+        return [
+            number
+            for number in map(self.documents.__getitem__, sorted(doc_ids or ()))
+            if number is not None
+        ]
+
+    def search(self, query):
+        """Application numbers of documents containing all terms of `query`"""
+        return self.lookup(tokenize(query))
+
+    def search_prefix(self, query):
+        """Like `search`, but the last term of `query` matches as a prefix"""
+        if not (terms := tokenize(query)):
+            return []
+        return self.lookup(terms[:-1], prefix=terms[-1])
+
+    def save(self, path):
+        terms = self.terms()
+        header = json.dumps(
+            {
+                "documents": self.documents,
+                "terms": terms,
+                "lengths": [len(self.postings[x]) for x in terms],
+            }
+        ).encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(self.magic)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for term in terms:
+                posting = self.postings[term]
+                if sys.byteorder == "big":
+                    posting = array("I", posting)
+                    posting.byteswap()
+                posting.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if f.read(len(cls.magic)) != cls.magic:
+                raise ValueError(f"{path!r} is not a text index file")
+            (size,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(size))
+            data = array("I")
+            data.frombytes(f.read())
+        if sys.byteorder == "big":
+            data.byteswap()
+        index = cls()
+        index.documents = header["documents"]
+        index.doc_ids = {
+            number: i for i, number in enumerate(index.documents) if number is not None
+        }
+        offset = 0
+        for term, length in zip(header["terms"], header["lengths"]):
+            index.postings[term] = data[offset : offset + length]
+            offset += length
+        index._terms = header["terms"]
+        return index
+
+
+"""Document store"""
+
+
+store_magic = b"OPSDOCS1"
+
+# n_statuses, n_events, n_steps, n_fields, bibliographic data length
+record_header = struct.Struct("<IIIII")
+# date, code, text (string ids)
+status_record = struct.Struct("<III")
+# date (ordinal), code, description (string ids)
+event_record = struct.Struct("<III")
+# code, description (string ids), number of fields
+step_record = struct.Struct("<III")
+# key (string id), value kind, value
+field_record = struct.Struct("<IIi")
+# number (string id), record offset, record length
+index_record = struct.Struct("<IQI")
+# first string id, number of strings
+string_chunk = struct.Struct("<II")
+# magic, offset of the latest committed footer (0 for an empty store)
+store_header = struct.Struct("<8sQ")
+# magic, previous footer offset, string chunk offset, index segment offset,
+# index segment length, number of documents, whether the segment is a full index
+store_footer = struct.Struct("<8sQQQQQI")
+
+no_string = 0xFFFFFFFF
+
+field_none, field_date, field_int, field_str = range(4)
+
+
+def encode_json(value):
+    if isinstance(value, datetime.date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Cannot encode {value!r}")
+
+
+def decode_json(value):
+    if "$date" in value:
+        return datetime.date.fromisoformat(value["$date"])
+    return value
+
+
+class DocumentStoreWriter:
+    """Append register documents to a DocumentStore file
+
+    The file is only ever appended to. Records are written as they are
+    appended; `commit` then appends the strings and index entries new
+    since the last commit and a footer, and finally points the file
+    header at the new footer. Until then readers, and a crashed writer,
+    see the previous commit. `close` commits.
+
+    Readers merge the index segments of all commits back to the latest
+    full index. Every `index_segments` commits the writer writes a full
+    index instead of a segment, which bounds the lookup cost at the
+    price of one dead copy of the index.
+
+    A document appended with an application number already in the
+    store replaces the earlier one in the index.
+
+    """
+
+    def __init__(self, path, index_segments=32):
+        self.strings = []
+        self.string_ids = {}
+        self.index = {}
+        self.new_index = {}
+        self.index_segments = index_segments
+        self.footer_offset = 0
+        self.segments = 0
+        if os.path.exists(path) and os.path.getsize(path):
+            with DocumentStore(path) as store:
+                for i in range(store.string_count):
+                    self.string_id(store.string(i))
+                self.index = store.entries()
+                self.footer_offset = store.footer_offset
+                self.segments = len(store.segments)
+            self.file = open(path, "r+b")
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            self.file.write(store_header.pack(store_magic, 0))
+        self.committed_strings = len(self.strings)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def string_id(self, value):
+        if value is None:
+            return no_string
+        if (i := self.string_ids.get(value)) is None:
+            i = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return i
+
+    def field(self, key, value):
+        if value is None:
+            kind, value = field_none, 0
+        elif isinstance(value, datetime.date):
+            kind, value = field_date, value.toordinal()
+        elif isinstance(value, int):
+            kind = field_int
+        else:
+            kind, value = field_str, self.string_id(value)
+        return field_record.pack(self.string_id(key), kind, value)
+
+    def append(self, doc):
+        s = self.string_id
+        statuses = [
+            status_record.pack(s(x["date"]), s(x["code"]), s(x["text"]))
+            for x in doc["statuses"]
+        ]
+        events = [
+            event_record.pack(
+                x["date"].toordinal() if x["date"] else 0,
+                s(x["code"]),
+                s(x["description"]),
+            )
+            for x in doc["events"]
+        ]
+        steps, fields = [], []
+        for step in doc["procedural_data"]:
+            extra = [
+                self.field(key, value)
+                for key, value in step.items()
+                if key not in ("code", "description")
+            ]
+            steps.append(
+                step_record.pack(s(step["code"]), s(step["description"]), len(extra))
+            )
+            fields.extend(extra)
+        bib = json.dumps(
+            doc["bibliographic_data"], default=encode_json, separators=(",", ":")
+        ).encode("utf-8")
+        record = b"".join(
+            [
+                record_header.pack(
+                    len(statuses), len(events), len(steps), len(fields), len(bib)
+                ),
+                *statuses,
+                *events,
+                *steps,
+                *fields,
+                bib,
+            ]
+        )
+        number = doc["bibliographic_data"]["application_number"]
+        self.index[number] = self.new_index[number] = (self.file.tell(), len(record))
+        self.file.write(record)
+
+    def update(self, docs):
+        for doc in docs:
+            self.append(doc)
+
+    def commit(self):
+        if not self.new_index:
+            return
+        full = self.segments >= self.index_segments
+        segment = self.index if full else self.new_index
+        for number in segment:
+            self.string_id(number)
+        f = self.file
+        strings_offset = f.tell()
+        blobs = [x.encode("utf-8") for x in self.strings[self.committed_strings :]]
+        offsets = [0]
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        f.write(string_chunk.pack(self.committed_strings, len(blobs)))
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        f.writelines(blobs)
+        index_offset = f.tell()
+        for number in sorted(segment):
+            offset, length = segment[number]
+            f.write(index_record.pack(self.string_ids[number], offset, length))
+        footer_offset = f.tell()
+        f.write(
+            store_footer.pack(
+                store_magic,
+                self.footer_offset,
+                strings_offset,
+                index_offset,
+                len(segment),
+                len(self.index),
+                full or not self.footer_offset,
+            )
+        )
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(0)
+        f.write(store_header.pack(store_magic, footer_offset))
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(0, os.SEEK_END)
+        self.footer_offset = footer_offset
+        self.committed_strings = len(self.strings)
+        self.new_index = {}
+        self.segments = 1 if full else self.segments + 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.commit()
+        self.file.close()
+
+
+class DocumentStore:
+    """Read register documents from a file written by DocumentStoreWriter
+
+    The file is memory mapped. Single documents, or single sections of
+    a document, are decoded on request; nothing is loaded up front.
+
+    """
+
+    sections = ("statuses", "bibliographic_data", "procedural_data", "events")
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self.mmap
+        magic, self.footer_offset = store_header.unpack_from(buf, 0)
+        if magic != store_magic:
+            self.close()
+            raise ValueError(f"{path!r} is not a document store")
+        self.chunks = []
+        self.segments = []
+        self.count = 0
+        complete = False
+        footer = self.footer_offset
+        while footer:
+            magic, previous, strings, index, length, count, full = (
+                store_footer.unpack_from(buf, footer)
+            )
+            if magic != store_magic:
+                self.close()
+                raise ValueError(f"{path!r} has a corrupt footer at {footer}")
+            if footer == self.footer_offset:
+                self.count = count
+            if not complete:
+                self.segments.append((index, length))
+                complete = full
+            first, n = string_chunk.unpack_from(buf, strings)
+            offsets = strings + string_chunk.size
+            self.chunks.append((first, n, offsets, offsets + 8 * (n + 1)))
+            footer = previous
+        self.chunks.reverse()
+        self.chunk_starts = [x[0] for x in self.chunks]
+        self.string_count = sum(x[1] for x in self.chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.mmap.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Application numbers in ascending order"""
+        numbers = heapq.merge(*map(self.segment_numbers, self.segments))
+        return (number for number, _ in itertools.groupby(numbers))
+
+    def __contains__(self, number):
+        return self.find(number) is not None
+
+    def string(self, i):
+        if i == no_string:
+            return None
+        first, _, offsets, data = self.chunks[
+            bisect.bisect_right(self.chunk_starts, i) - 1
+        ]
+        start, end = struct.unpack_from("<QQ", self.mmap, offsets + 8 * (i - first))
+        return self.mmap[data + start : data + end].decode("utf-8")
+
+    def index_entry(self, segment, i):
+        string_id, offset, length = index_record.unpack_from(
+            self.mmap, segment[0] + i * index_record.size
+        )
+        return self.string(string_id), offset, length
+
+    def segment_numbers(self, segment):
+        return (self.index_entry(segment, i)[0] for i in range(segment[1]))
+
+    def entries(self):
+        """Map of application numbers to (offset, length) of their record"""
+        entries = {}
+        for segment in reversed(self.segments):
+            for i in range(segment[1]):
+                number, offset, length = self.index_entry(segment, i)
+                entries[number] = (offset, length)
+        return entries
+
+    def find(self, number):
+        """Record offset of `number`, looked up in the newest segment first"""
+        for segment in self.segments:
+            lo, hi = 0, segment[1]
+            while lo < hi:
+                mid = (lo + hi) // 2
+                key, offset, length = self.index_entry(segment, mid)
+                if key < number:
+                    lo = mid + 1
+                elif key > number:
+                    hi = mid
+                else:
+                    return offset
+        return None
+
+    def record(self, number):
+        if (offset := self.find(number)) is None:
+            raise KeyError(number)
+        n_statuses, n_events, n_steps, n_fields, n_bib = record_header.unpack_from(
+            self.mmap, offset
+        )
+        statuses = offset + record_header.size
+        events = statuses + n_statuses * status_record.size
+        steps = events + n_events * event_record.size
+        fields = steps + n_steps * step_record.size
+        bib = fields + n_fields * field_record.size
+        return {
+            "statuses": (statuses, n_statuses),
+            "events": (events, n_events),
+            "procedural_data": (steps, n_steps, fields),
+            "bibliographic_data": (bib, n_bib),
+        }
+
+    def get(self, number):
+        record = self.record(number)
+        return {name: self.decode(name, record[name]) for name in self.sections}
+
+    def section(self, number, name):
+        if name not in self.sections:
+            raise KeyError(name)
+        return self.decode(name, self.record(number)[name])
+
+    def decode(self, name, location):
+        return getattr(self, "decode_" + name)(*location)
+
+    def decode_statuses(self, offset, count):
+        s = self.string
+        return [
+            {"date": s(d), "code": s(c), "text": s(t)}
+            for d, c, t in status_record.iter_unpack(
+                self.mmap[offset : offset + count * status_record.size]
+            )
+        ]
+
+    def decode_events(self, offset, count):
+        s = self.string
+        return [
+            {
+                "date": datetime.date.fromordinal(d) if d else None,
+                "code": s(c),
+                "description": s(t),
+            }
+            for d, c, t in event_record.iter_unpack(
+                self.mmap[offset : offset + count * event_record.size]
+            )
+        ]
+
+    def decode_procedural_data(self, offset, count, fields):
+        s = self.string
+        steps = []
+        for code, description, n in step_record.iter_unpack(
+            self.mmap[offset : offset + count * step_record.size]
+        ):
+            step = {"code": s(code), "description": s(description)}
+            for key, kind, value in field_record.iter_unpack(
+                self.mmap[fields : fields + n * field_record.size]
+            ):
+                if kind == field_none:
+                    value = None
+                elif kind == field_date:
+                    value = datetime.date.fromordinal(value)
+                elif kind == field_str:
+                    value = s(value)
+                step[s(key)] = value
+            fields += n * field_record.size
+            steps.append(step)
+        return steps
+
+    def decode_bibliographic_data(self, offset, length):
+        return json.loads(
+            self.mmap[offset : offset + length].decode("utf-8"),
+            object_hook=decode_json,
+        )
@@ -1,8 +1,15 @@
 import os
+import re
+import json
+import pickle
+import subprocess
+import sys
 import datetime
 import pytest
 import python_ops_parser as parser
 
+from collections import Counter
+
 from .samples import SAMPLES, SAMPLE_DIR
 
 """Fixtures"""
@@ -276,3 +283,556 @@ def test_query(register_search):
 
 def test_range(register_search):
     assert register_search["register_search"]["range"] == (1, 25)
+
+
+"""Text index"""
+
+
+@pytest.fixture(scope="session")
+def text_index(register_search, register_document, ep00102678):
+    index = parser.TextIndex()
+    index.update(register_search["register_search"]["register_documents"])
+    index.update([register_document, ep00102678])
+    return index
+
+
+def test_tokenize():
+    assert parser.tokenize("Green BRICKS, for the brick-industry") == [
+        "green",
+        "bricks",
+        "for",
+        "the",
+        "brick",
+        "industry",
+    ]
+
+
+def test_text_index_title(text_index):
+    assert "99203729" in text_index.search("green bricks")
+    assert "99203729" in text_index.search("Steinformlingen")
+
+
+def test_text_index_parties(text_index):
+    assert "99203729" in text_index.search("Nijmegen")
+    assert "15171792" in text_index.search("BASF")
+
+
+def test_text_index_npl_citation(text_index):
+    assert "00102678" in text_index.search("patent abstracts of japan")
+
+
+def test_text_index_prefix(text_index):
+    assert "99203729" in text_index.search_prefix("Steinform")
+    assert text_index.search_prefix("xqzxqz") == []
+
+
+def test_text_index_prefix_is_tokenized(text_index):
+    assert "99203729" in text_index.search_prefix("Green brick")
+    assert "99203729" in text_index.search_prefix("green-bri")
+    assert "99203729" not in text_index.search_prefix("bricks-xqzxqz")
+
+
+def test_text_index_replaces_document(register_document):
+    index = parser.TextIndex()
+    index.add(register_document)
+    doc = dict(register_document)
+    doc["bibliographic_data"] = dict(doc["bibliographic_data"], title_en="Carpets")
+    index.add(doc)
+    assert len(index) == 1
+    assert index.search("carpets") == ["99203729"]
+    assert index.search("Steinformlingen") == ["99203729"]
+    assert index.search("green bricks") == []
+
+
+def test_text_index_save_and_load(text_index, tmp_path):
+    path = tmp_path / "text.idx"
+    text_index.save(path)
+    index = parser.TextIndex.load(path)
+    assert index.documents == text_index.documents
+    assert index.search("green bricks") == text_index.search("green bricks")
+    assert index.search_prefix("nijm") == text_index.search_prefix("nijm")
+
+
+"""Schema coverage"""
+
+
+def test_coverage_is_opt_in(xmlsamples):
+    parser.from_string(xmlsamples["99203729"])
+    assert parser.coverage.get() is None
+
+
+def test_coverage_unknown_step_code():
+    node = parser.ET.fromstring(
+        f'<procedural-step xmlns="{parser.ns["reg"]}">'
+        "<procedural-step-code>XXXX</procedural-step-code>"
+        '<procedural-step-text step-text-type="STEP_DESCRIPTION">X</procedural-step-text>'
+        '<procedural-step-text step-text-type="NEW_TEXT">Y</procedural-step-text>'
+        '<procedural-step-date step-date-type="NEW_DATE"><date>20200101</date></procedural-step-date>'
+        "</procedural-step>"
+    )
+    with parser.collect_coverage() as counter:
+        parser.procedural_step(node)
+    assert counter == {
+        ("procedural-step-code", "XXXX"): 1,
+        ("step-text-type", "XXXX NEW_TEXT"): 1,
+        ("step-date-type", "XXXX NEW_DATE"): 1,
+    }
+
+
+def test_coverage_step_types_are_per_step_code():
+    node = parser.ET.fromstring(
+        f'<procedural-step xmlns="{parser.ns["reg"]}">'
+        "<procedural-step-code>AGRA</procedural-step-code>"
+        '<procedural-step-text step-text-type="STEP_DESCRIPTION">X</procedural-step-text>'
+        '<procedural-step-date step-date-type="DATE_OF_DISPATCH"><date>20200101</date></procedural-step-date>'
+        '<procedural-step-date step-date-type="DATE_OF_PAYMENT"><date>20200101</date></procedural-step-date>'
+        "<time-limit>M04</time-limit>"
+        "</procedural-step>"
+    )
+    with parser.collect_coverage() as counter:
+        parser.procedural_step(node)
+    assert counter == {
+        ("step-date-type", "AGRA DATE_OF_PAYMENT"): 1,
+        ("procedural-step", "AGRA time-limit"): 1,
+    }
+
+
+def test_opposition_sequence_number():
+    node = parser.ET.fromstring(
+        f'<procedural-step xmlns="{parser.ns["reg"]}">'
+        "<procedural-step-code>OPEX</procedural-step-code>"
+        '<procedural-step-text step-text-type="STEP_DESCRIPTION">X</procedural-step-text>'
+        '<procedural-step-text step-text-type="sequence-number">2</procedural-step-text>'
+        "</procedural-step>"
+    )
+    with parser.collect_coverage() as counter:
+        step = parser.procedural_step(node)
+    assert step["opponent"] == 2
+    assert counter == {}
+
+
+def test_coverage_parties_and_events():
+    node = parser.ET.fromstring(
+        f'<register-document xmlns="{parser.ns["reg"]}">'
+        "<events-data><dossier-event>"
+        "<event-code>0009</event-code><event-date><date>20200101</date></event-date>"
+        "<event-text>X</event-text><gazette-reference/>"
+        "</dossier-event></events-data></register-document>"
+    )
+    with parser.collect_coverage() as counter:
+        parser.events(node)
+    assert counter == {("dossier-event", "gazette-reference"): 1}
+
+
+def test_coverage_aggregates_over_batch(xmlsamples):
+    with parser.collect_coverage() as counter:
+        parser.from_string(xmlsamples["99203729"])
+    once = Counter(counter)
+    with parser.collect_coverage(counter):
+        parser.from_string(xmlsamples["99203729"])
+    assert counter == once + once
+    assert ("procedural-step-code", "RFEE") not in counter
+    assert all(kind in parser.coverage_report(counter) for kind, _ in counter)
+
+
+"""Document store"""
+
+
+@pytest.fixture
+def document_store(tmp_path, register_search, register_document):
+    path = tmp_path / "documents.bin"
+    with parser.DocumentStoreWriter(path) as writer:
+        writer.update(register_search["register_search"]["register_documents"])
+    with parser.DocumentStoreWriter(path) as writer:
+        writer.append(register_document)
+    with parser.DocumentStore(path) as store:
+        yield store
+
+
+def test_document_store_get(document_store, register_document, register_search):
+    assert document_store.get("99203729") == register_document
+    doc = register_search["register_search"]["register_documents"][0]
+    assert document_store.get("15171792") == doc
+
+
+def test_document_store_section(document_store, event_data, procedural_data):
+    assert document_store.section("99203729", "events") == event_data
+    assert document_store.section("99203729", "procedural_data") == procedural_data
+
+
+def test_document_store_index(document_store):
+    assert len(document_store) == 26
+    assert "99203729" in document_store
+    assert "00000000" not in document_store
+    assert list(document_store) == sorted(document_store)
+    with pytest.raises(KeyError):
+        document_store.get("00000000")
+
+
+def test_document_store_survives_killed_writer(tmp_path, register_document):
+    path = tmp_path / "documents.bin"
+    with parser.DocumentStoreWriter(path) as writer:
+        writer.append(register_document)
+    size = path.stat().st_size
+    code = (
+        "import os, python_ops_parser as parser\n"
+        f"store = parser.DocumentStore({str(path)!r})\n"
+        "doc = store.get('99203729')\n"
+        "doc['bibliographic_data']['application_number'] = '00000001'\n"
+        "doc['bibliographic_data']['title_en'] = 'A new title'\n"
+        f"writer = parser.DocumentStoreWriter({str(path)!r})\n"
+        "writer.append(doc)\n"
+        "writer.file.flush()\n"
+        "os._exit(1)\n"
+    )
+    cwd = os.path.dirname(os.path.abspath(parser.__file__))
+    assert subprocess.run([sys.executable, "-c", code], cwd=cwd).returncode == 1
+    assert path.stat().st_size > size
+    with parser.DocumentStore(path) as store:
+        assert list(store) == ["99203729"]
+        assert store.get("99203729") == register_document
+    with parser.DocumentStoreWriter(path) as writer:
+        writer.append(register_document)
+    with parser.DocumentStore(path) as store:
+        assert store.get("99203729") == register_document
+
+
+def test_document_store_reader_keeps_snapshot(tmp_path, register_search):
+    docs = register_search["register_search"]["register_documents"]
+    path = tmp_path / "documents.bin"
+    with parser.DocumentStoreWriter(path) as writer:
+        writer.update(docs[:10])
+    with parser.DocumentStore(path) as store:
+        with parser.DocumentStoreWriter(path) as writer:
+            writer.update(docs[10:])
+        assert len(store) == 10
+        assert store.get(docs[0]["bibliographic_data"]["application_number"]) == docs[0]
+    with parser.DocumentStore(path) as store:
+        assert len(store) == 25
+
+
+def test_document_store_index_segments(tmp_path, register_search):
+    docs = register_search["register_search"]["register_documents"]
+    single, segmented = tmp_path / "single.bin", tmp_path / "segmented.bin"
+    with parser.DocumentStoreWriter(single) as writer:
+        writer.update(docs)
+    with parser.DocumentStoreWriter(segmented) as writer:
+        for doc in docs:
+            writer.append(doc)
+            writer.commit()
+    # each commit adds a footer and a string chunk header, not an index copy
+    overhead = parser.store_footer.size + parser.string_chunk.size + 8
+    assert segmented.stat().st_size - single.stat().st_size <= len(docs) * overhead
+    with parser.DocumentStore(segmented) as store:
+        assert list(store) == sorted(application_numbers(docs))
+        assert [store.get(x) for x in application_numbers(docs)] == docs
+
+
+def test_document_store_full_index(tmp_path, register_search):
+    docs = register_search["register_search"]["register_documents"]
+    path = tmp_path / "documents.bin"
+    with parser.DocumentStoreWriter(path, index_segments=4) as writer:
+        for doc in docs:
+            writer.append(doc)
+            writer.commit()
+    with parser.DocumentStoreWriter(path, index_segments=4) as writer:
+        writer.append(docs[0])
+    with parser.DocumentStore(path) as store:
+        assert len(store.segments) <= 4
+        assert len(store) == len(docs)
+        assert list(store) == sorted(application_numbers(docs))
+        assert [store.get(x) for x in application_numbers(docs)] == docs
+
+
+@pytest.fixture(scope="session")
+def register_search_file(xmlsamples, tmp_path_factory):
+    path = tmp_path_factory.mktemp("samples") / "register_search.xml"
+    path.write_text(xmlsamples["register_search"], encoding="utf-8")
+    return path
+
+
+def application_numbers(docs):
+    return [x["bibliographic_data"]["application_number"] for x in docs]
+
+
+def test_iter_documents(register_search_file, register_search):
+    docs = list(parser.iter_documents(register_search_file))
+    assert docs == register_search["register_search"]["register_documents"]
+
+
+def test_parse_batch(register_search_file):
+    docs = list(parser.parse_batch([register_search_file, register_search_file]))
+    assert len(docs) == 50
+
+
+def test_filter_status_code():
+    node = parser.ET.fromstring(
+        f'<register-document xmlns="{parser.ns["reg"]}"><ep-patent-statuses>'
+        '<ep-patent-status status-code="7">No opposition</ep-patent-status>'
+        "</ep-patent-statuses></register-document>"
+    )
+    assert parser.status_code("7", "8")(node)
+    assert not parser.status_code("8")(node)
+    assert (~parser.status_code("8"))(node)
+
+
+def test_filter_application_number(register_search_file):
+    where = parser.application_number("15171792")
+    docs = list(parser.iter_documents(register_search_file, where))
+    assert application_numbers(docs) == ["15171792"]
+
+
+def test_filter_filing_date(register_search_file, register_search):
+    start = datetime.date(2015, 1, 1)
+    where = parser.filing_date(start=start)
+    docs = register_search["register_search"]["register_documents"]
+    expected = [x for x in docs if x["bibliographic_data"]["filing_date"] >= start]
+    assert list(parser.iter_documents(register_search_file, where)) == expected
+
+
+def test_filter_combined(xmlsamples):
+    where = parser.applicant_country("NL") & parser.event_code("EPIDOSDTIPA")
+    data = parser.from_string(xmlsamples["99203729"], where)
+    assert len(data["register_search"]["register_documents"]) == 1
+    where = parser.applicant_country("NL") & ~parser.event_code("EPIDOSDTIPA")
+    data = parser.from_string(xmlsamples["99203729"], where)
+    assert data["register_search"]["register_documents"] == []
+
+
+def test_filter_cost_order():
+    calls = []
+
+    def spy(name, cost, result):
+        return parser.Filter(lambda node: calls.append(name) or result, cost=cost)
+
+    assert not (spy("expensive", 3, True) & spy("cheap", 0, False))(None)
+    assert calls == ["cheap"]
+
+    calls.clear()
+    where = spy("event", 3, True) & spy("status", 0, True) & spy("applicant", 2, True)
+    assert where(None)
+    assert calls == ["status", "applicant", "event"]
+
+    calls.clear()
+    where = spy("event", 3, False) | spy("status", 0, False) | spy("applicant", 2, True)
+    assert where(None)
+    assert calls == ["status", "applicant"]
+
+
+def test_filter_nesting():
+    where = (parser.status_code("7") | parser.event_code("0009")) & parser.filing_date()
+    assert isinstance(where, parser.AllOf)
+    assert [type(x) for x in where.filters] == [parser.Filter, parser.AnyOf]
+
+
+def test_filter_combines_with_callables():
+    calls = []
+    where = parser.Filter(lambda node: calls.append("filter") or False, cost=3)
+    assert not (where & (lambda node: calls.append("callable") or True))(None)
+    assert calls == ["filter"]
+    assert ((lambda node: True) | where)(None)
+
+
+"""Document index"""
+
+
+def test_build_document_index(register_search_file):
+    index = parser.build_document_index(register_search_file)
+    assert len(index["documents"]) == 25
+    assert os.path.exists(parser.document_index_path(register_search_file))
+    assert index["unnumbered"] == []
+    [(offset, length)] = index["documents"]["15171792"]
+    with open(register_search_file, "rb") as f:
+        f.seek(offset)
+        fragment = f.read(length)
+    assert fragment.startswith(b"<reg:register-document")
+    assert fragment.endswith(b"register-document>")
+
+
+def test_load_document(register_search_file, register_search):
+    for doc in register_search["register_search"]["register_documents"]:
+        number = doc["bibliographic_data"]["application_number"]
+        assert parser.load_document(register_search_file, number) == doc
+
+
+def test_document_index_duplicates_and_unnumbered(xmlsamples, tmp_path):
+    xml = xmlsamples["register_search"]
+    start = re.search(r"<reg:register-document[\s>]", xml).start()
+    end = xml.index("</reg:register-document>") + len("</reg:register-document>")
+    first = xml[start:end]
+    changed = first.replace('status-code="', 'status-code="X', 1)
+    unnumbered = re.sub(
+        r"(<reg:application-reference.*?<reg:doc-number>)[^<]*",
+        r"\g<1>",
+        first,
+        flags=re.S,
+    )
+    path = tmp_path / "duplicates.xml"
+    path.write_text(xml[:end] + changed + unnumbered + xml[end:], encoding="utf-8")
+    index = parser.document_index(path)
+    assert len(index["documents"]["15171792"]) == 2
+    assert len(index["unnumbered"]) == 1
+    assert None not in index["documents"] and "null" not in index["documents"]
+    latest = parser.load_document(path, "15171792", index)
+    assert latest["statuses"][0]["code"].startswith("X")
+    earliest = parser.load_document(path, "15171792", index, occurrence=0)
+    assert not earliest["statuses"][0]["code"].startswith("X")
+
+
+def test_load_document_unknown_number(register_search_file):
+    with pytest.raises(KeyError):
+        parser.load_document(register_search_file, "00000000")
+
+
+"""Fault isolation"""
+
+
+@pytest.fixture(scope="session")
+def malformed_file(xmlsamples, tmp_path_factory):
+    """Register search whose first document lacks an event code"""
+    xml = re.sub(
+        r"<reg:event-code>[^<]*</reg:event-code>",
+        "",
+        xmlsamples["register_search"],
+        count=1,
+    )
+    path = tmp_path_factory.mktemp("samples") / "malformed.xml"
+    path.write_text(xml, encoding="utf-8")
+    return path
+
+
+def test_on_error_raise(malformed_file):
+    with pytest.raises(parser.DocumentError) as e:
+        list(parser.iter_documents(malformed_file))
+    assert e.value.index == 0
+    assert e.value.application_number == "15171792"
+    assert e.value.function == "dossier_event"
+    assert isinstance(e.value.error, AttributeError)
+
+
+def test_on_error_skip(malformed_file, register_search):
+    errors = []
+    docs = list(parser.iter_documents(malformed_file, on_error="skip", errors=errors))
+    assert docs == register_search["register_search"]["register_documents"][1:]
+    assert [(x.index, x.function, x.xml) for x in errors] == [
+        (0, "dossier_event", None)
+    ]
+
+
+def test_on_error_quarantine(malformed_file):
+    errors = []
+    docs = parser.iter_documents(malformed_file, on_error="quarantine", errors=errors)
+    assert len(list(docs)) == 24
+    assert "15171792" in errors[0].xml
+
+
+def test_iter_documents_start(register_search_file, register_search):
+    docs = list(parser.iter_documents(register_search_file, start=20))
+    assert docs == register_search["register_search"]["register_documents"][20:]
+
+
+def test_parse_batch_checkpoint(register_search_file, tmp_path):
+    checkpoint = tmp_path / "checkpoint.json"
+    sources = [register_search_file, register_search_file]
+    batch = parser.parse_batch(sources, checkpoint=checkpoint, checkpoint_every=1)
+    first = [next(batch) for _ in range(30)]
+    batch.close()
+    rest = list(parser.parse_batch(sources, checkpoint=checkpoint))
+    assert application_numbers(first[:29] + rest) == application_numbers(
+        parser.parse_batch(sources)
+    )
+    assert list(parser.parse_batch(sources, checkpoint=checkpoint)) == []
+
+
+def test_xml_syntax_error_moves_on_to_next_source(
+    xmlsamples, tmp_path, register_search_file
+):
+    xml = xmlsamples["register_search"]
+    end = xml.index("</reg:register-document>") + len("</reg:register-document>")
+    broken = tmp_path / "broken.xml"
+    broken.write_text(
+        xml[:end] + xml[end:].replace("</reg:event-text>", "</reg:event-txt>", 1),
+        encoding="utf-8",
+    )
+    errors = []
+    sources = [broken, register_search_file]
+    docs = list(parser.parse_batch(sources, on_error="skip", errors=errors))
+    assert len(docs) == 26
+    assert [(x.source, x.index, x.function) for x in errors] == [(broken, 0, None)]
+    assert isinstance(errors[0].error, parser.ET.ParseError)
+    with pytest.raises(parser.DocumentError):
+        list(parser.parse_batch(sources))
+
+
+def test_failing_function_skips_helpers(xmlsamples, tmp_path):
+    xml = re.sub(
+        r"(<reg:application-reference[^>]*>.*?<reg:date>)\d{8}",
+        r"\g<1>2000xx01",
+        xmlsamples["99203729"],
+        count=1,
+        flags=re.S,
+    )
+    path = tmp_path / "bad_date.xml"
+    path.write_text(xml, encoding="utf-8")
+    errors = []
+    assert list(parser.iter_documents(path, on_error="skip", errors=errors)) == []
+    assert errors[0].function == "document_id"
+    assert errors[0].application_number == "99203729"
+
+
+def test_parse_batch_checkpoint_sources(register_search_file, tmp_path):
+    checkpoint = tmp_path / "checkpoint.json"
+    list(parser.parse_batch([register_search_file], checkpoint=checkpoint))
+    with pytest.raises(ValueError):
+        list(parser.parse_batch([register_search_file] * 2, checkpoint=checkpoint))
+
+
+def test_parse_batch_checkpoint_counts_scanned_documents(
+    register_search_file, tmp_path
+):
+    checkpoint = tmp_path / "checkpoint.json"
+    where = ~parser.application_number("15171792")
+    batch = parser.parse_batch(
+        [register_search_file], where, checkpoint=checkpoint, checkpoint_every=1
+    )
+    next(batch)
+    batch.close()
+    assert json.loads(checkpoint.read_text())["document"] == 1
+
+
+def test_coverage_unknown_citations_with_skip(xmlsamples, tmp_path):
+    xml = re.sub(
+        r"<reg:patcit\b.*?</reg:patcit>",
+        "<reg:othercit/>",
+        xmlsamples["99203729"],
+        flags=re.S,
+    )
+    path = tmp_path / "unknown_citations.xml"
+    path.write_text(xml, encoding="utf-8")
+    errors = []
+    with parser.collect_coverage() as counter:
+        docs = list(parser.parse_batch([path, path], on_error="skip", errors=errors))
+    assert docs == []
+    assert [x.function for x in errors] == ["citation", "citation"]
+    assert isinstance(errors[0].error, parser.SchemaError)
+    shapes = {name: n for (kind, name), n in counter.items() if kind == "citation"}
+    assert all("othercit" in x for x in shapes)
+    assert sum(shapes.values()) == 2
+    assert counter[("procedural-step-code", "RFEE")] == 0
+
+
+def test_document_error_pickles(malformed_file):
+    errors = []
+    with open(malformed_file, "rb") as f:
+        list(parser.iter_documents(f, on_error="quarantine", errors=errors))
+    error = pickle.loads(pickle.dumps(errors[0]))
+    assert isinstance(error, parser.DocumentError)
+    assert str(error) == str(errors[0])
+    assert error.source == str(malformed_file)
+    assert (error.index, error.application_number, error.function) == (
+        0,
+        "15171792",
+        "dossier_event",
+    )
+    assert isinstance(error.error, AttributeError)
+    assert error.xml == errors[0].xml